@@ -1,21 +1,34 @@
+import sys
+from collections import deque
+from typing import Deque, Dict, Optional
+
 from anysystem import Context, Message, Process
 
+# message types and timer names, interned once so comparisons with msg.type
+# and timer_name usually succeed on the identity check
+MESSAGE = sys.intern("MESSAGE")
+DATA = sys.intern("DATA")
+ACK = sys.intern("ACK")
+CACK = sys.intern("CACK")
+RTX_TIMER = sys.intern("rtx")
+ACK_DELAY_TIMER = sys.intern("ack_delay")
+
 
 # AT MOST ONCE ---------------------------------------------------------------------------------------------------------
 
 
 class AtMostOnceSender(Process):
     def __init__(self, proc_id: str, receiver_id: str):
-        self._id = proc_id
-        self._receiver = receiver_id
-        self._next_seq = 1
+        self._id: str = proc_id
+        self._receiver: str = receiver_id
+        self._next_seq: int = 1
 
     def on_local_message(self, msg: Message, ctx: Context):
-        if msg.type != "MESSAGE":
+        if msg.type != MESSAGE:
             return
         seq = self._next_seq
         self._next_seq += 1
-        ctx.send(Message("DATA", {"seq": seq, "text": msg["text"]}), self._receiver)
+        ctx.send(Message(DATA, {"seq": seq, "text": msg["text"]}), self._receiver)
 
     def on_message(self, msg: Message, sender: str, ctx: Context):
         pass
@@ -26,16 +39,16 @@ class AtMostOnceSender(Process):
 
 class AtMostOnceReceiver(Process):
     def __init__(self, proc_id: str):
-        self._id = proc_id
-        self._next_seq = 1
-        self._buffer = {}
-        self._max_buffer = 12
+        self._id: str = proc_id
+        self._next_seq: int = 1
+        self._buffer: Dict[int, str] = {}
+        self._max_buffer: int = 12
 
     def on_local_message(self, msg: Message, ctx: Context):
         pass
 
     def _deliver(self, text: str, ctx: Context):
-        ctx.send_local(Message("MESSAGE", {"text": text}))
+        ctx.send_local(Message(MESSAGE, {"text": text}))
 
     def _flush(self, ctx: Context):
         while self._next_seq in self._buffer:
@@ -53,7 +66,7 @@ class AtMostOnceReceiver(Process):
         self._flush(ctx)
 
     def on_message(self, msg: Message, sender: str, ctx: Context):
-        if msg.type != "DATA":
+        if msg.type != DATA:
             return
         seq = msg["seq"]
         text = msg["text"]
@@ -73,83 +86,102 @@ class AtMostOnceReceiver(Process):
         pass
 
 
-# AT LEAST ONCE --------------------------------------------------------------------------------------------------------
+# SLIDING WINDOW SENDER ------------------------------------------------------------------------------------------------
+
 
+class _WindowedSender(Process):
+    WINDOW = 10
+    TIMEOUT = 6.5
+    TIMER = RTX_TIMER
 
-class AtLeastOnceSender(Process):
     def __init__(self, proc_id: str, receiver_id: str):
-        self._id = proc_id
-        self._receiver = receiver_id
-        self._next_seq = 1
-        self._base = 1
-        self._unacked = {}
-        self._pending = []
-        self._pending_idx = 0
-        self._window = 10
-        self._timeout = 6.5
-        self._timer = "rtx"
-        self._timer_active = False
+        self._id: str = proc_id
+        self._receiver: str = receiver_id
+        self._next_seq: int = 1
+        self._base: int = 1
+        self._unacked_mask: int = 0
+        self._unacked_text: Dict[int, str] = {}
+        self._pending: Optional[Deque[str]] = None
+        self._timer_active: bool = False
 
     def _has_window_space(self) -> bool:
-        return self._next_seq < self._base + self._window
+        return self._next_seq < self._base + self.WINDOW
 
     def _arm_timer(self, ctx: Context):
-        ctx.set_timer_once(self._timer, self._timeout)
+        ctx.set_timer_once(self.TIMER, self.TIMEOUT)
         self._timer_active = True
 
     def _disarm_timer(self, ctx: Context):
         if self._timer_active:
-            ctx.cancel_timer(self._timer)
+            ctx.cancel_timer(self.TIMER)
             self._timer_active = False
 
     def _restart_timer(self, ctx: Context):
         self._disarm_timer(ctx)
         self._arm_timer(ctx)
 
+    def _advance_base(self) -> bool:
+        if self._base == self._next_seq or self._unacked_mask & 1:
+            return False
+        if not self._unacked_mask:
+            self._base = self._next_seq
+            return True
+        lowest = self._unacked_mask & -self._unacked_mask
+        self._base += lowest.bit_length() - 1
+        self._unacked_mask //= lowest
+        return True
+
     def _send_data(self, seq: int, text: str, ctx: Context):
-        ctx.send(Message("DATA", {"seq": seq, "text": text}), self._receiver)
+        ctx.send(Message(DATA, {"seq": seq, "text": text}), self._receiver)
+
+    def _send_new(self, text: str, ctx: Context):
+        seq = self._next_seq
+        self._next_seq += 1
+        was_empty = not self._unacked_text
+        self._unacked_mask |= 2 ** (seq - self._base)
+        self._unacked_text[seq] = text
+        self._send_data(seq, text, ctx)
+        if was_empty:
+            self._restart_timer(ctx)
 
     def _try_send_pending(self, ctx: Context):
-        while self._pending_idx < len(self._pending) and self._has_window_space():
-            text = self._pending[self._pending_idx]
-            self._pending_idx += 1
-            seq = self._next_seq
-            self._next_seq += 1
-            was_empty = not self._unacked
-            self._unacked[seq] = text
-            self._send_data(seq, text, ctx)
-            if was_empty:
-                self._restart_timer(ctx)
-        if self._pending_idx > 0 and self._pending_idx * 2 >= len(self._pending):
-            self._pending = self._pending[self._pending_idx :]
-            self._pending_idx = 0
+        while self._pending and self._has_window_space():
+            self._send_new(self._pending.popleft(), ctx)
+        if not self._pending:
+            self._pending = None
 
     def on_local_message(self, msg: Message, ctx: Context):
-        if msg.type != "MESSAGE":
+        if msg.type != MESSAGE:
             return
         text = msg["text"]
         if self._has_window_space():
-            seq = self._next_seq
-            self._next_seq += 1
-            was_empty = not self._unacked
-            self._unacked[seq] = text
-            self._send_data(seq, text, ctx)
-            if was_empty:
-                self._restart_timer(ctx)
+            self._send_new(text, ctx)
         else:
+            if self._pending is None:
+                self._pending = deque()
             self._pending.append(text)
 
+    def _ack(self, seq: int):
+        if seq in self._unacked_text:
+            del self._unacked_text[seq]
+            self._unacked_mask &= ~(2 ** (seq - self._base))
+
+    def _on_ack(self, msg: Message):
+        self._ack(msg["seq"])
+
+    def _on_cumulative_ack(self, msg: Message):
+        for seq in range(self._base, msg["seq"] + 1):
+            self._ack(seq)
+
+    _MESSAGE_HANDLERS = {ACK: _on_ack, CACK: _on_cumulative_ack}
+
     def on_message(self, msg: Message, sender: str, ctx: Context):
-        if msg.type != "ACK":
+        handler = self._MESSAGE_HANDLERS.get(msg.type)
+        if handler is None:
             return
-        seq = msg["seq"]
-        if seq in self._unacked:
-            del self._unacked[seq]
-        base_changed = False
-        while self._base < self._next_seq and self._base not in self._unacked:
-            self._base += 1
-            base_changed = True
-        if not self._unacked:
+        handler(self, msg)
+        base_changed = self._advance_base()
+        if not self._unacked_text:
             self._disarm_timer(ctx)
         else:
             if base_changed:
@@ -157,29 +189,36 @@ class AtLeastOnceSender(Process):
         self._try_send_pending(ctx)
 
     def on_timer(self, timer_name: str, ctx: Context):
-        if timer_name != self._timer:
+        if timer_name != self.TIMER:
             return
         self._timer_active = False
-        if not self._unacked:
+        if not self._unacked_text:
             return
         seq = self._base
-        if seq in self._unacked:
-            self._send_data(seq, self._unacked[seq], ctx)
+        if seq in self._unacked_text:
+            self._send_data(seq, self._unacked_text[seq], ctx)
         self._arm_timer(ctx)
 
 
+# AT LEAST ONCE --------------------------------------------------------------------------------------------------------
+
+
+class AtLeastOnceSender(_WindowedSender):
+    pass
+
+
 class AtLeastOnceReceiver(Process):
     def __init__(self, proc_id: str):
-        self._id = proc_id
+        self._id: str = proc_id
 
     def on_local_message(self, msg: Message, ctx: Context):
         pass
 
     def on_message(self, msg: Message, sender: str, ctx: Context):
-        if msg.type != "DATA":
+        if msg.type != DATA:
             return
-        ctx.send_local(Message("MESSAGE", {"text": msg["text"]}))
-        ctx.send(Message("ACK", {"seq": msg["seq"]}), sender)
+        ctx.send_local(Message(MESSAGE, {"text": msg["text"]}))
+        ctx.send(Message(ACK, {"seq": msg["seq"]}), sender)
 
     def on_timer(self, timer_name: str, ctx: Context):
         pass
@@ -188,263 +227,114 @@ class AtLeastOnceReceiver(Process):
 # EXACTLY ONCE ---------------------------------------------------------------------------------------------------------
 
 
-class ExactlyOnceSender(Process):
-    def __init__(self, proc_id: str, receiver_id: str):
-        self._id = proc_id
-        self._receiver = receiver_id
-        self._next_seq = 1
-        self._base = 1
-        self._unacked = {}
-        self._pending = []
-        self._pending_idx = 0
-        self._window = 10
-        self._timeout = 6.5
-        self._timer = "rtx"
-        self._timer_active = False
-
-    def _has_window_space(self) -> bool:
-        return self._next_seq < self._base + self._window
-
-    def _arm_timer(self, ctx: Context):
-        ctx.set_timer_once(self._timer, self._timeout)
-        self._timer_active = True
-
-    def _disarm_timer(self, ctx: Context):
-        if self._timer_active:
-            ctx.cancel_timer(self._timer)
-            self._timer_active = False
-
-    def _restart_timer(self, ctx: Context):
-        self._disarm_timer(ctx)
-        self._arm_timer(ctx)
-
-    def _send_data(self, seq: int, text: str, ctx: Context):
-        ctx.send(Message("DATA", {"seq": seq, "text": text}), self._receiver)
-
-    def _try_send_pending(self, ctx: Context):
-        while self._pending_idx < len(self._pending) and self._has_window_space():
-            text = self._pending[self._pending_idx]
-            self._pending_idx += 1
-            seq = self._next_seq
-            self._next_seq += 1
-            was_empty = not self._unacked
-            self._unacked[seq] = text
-            self._send_data(seq, text, ctx)
-            if was_empty:
-                self._restart_timer(ctx)
-        if self._pending_idx > 0 and self._pending_idx * 2 >= len(self._pending):
-            self._pending = self._pending[self._pending_idx :]
-            self._pending_idx = 0
-
-    def on_local_message(self, msg: Message, ctx: Context):
-        if msg.type != "MESSAGE":
-            return
-        text = msg["text"]
-        if self._has_window_space():
-            seq = self._next_seq
-            self._next_seq += 1
-            was_empty = not self._unacked
-            self._unacked[seq] = text
-            self._send_data(seq, text, ctx)
-            if was_empty:
-                self._restart_timer(ctx)
-        else:
-            self._pending.append(text)
+class ExactlyOnceSender(_WindowedSender):
+    pass
 
-    def on_message(self, msg: Message, sender: str, ctx: Context):
-        if msg.type != "ACK":
-            return
-        seq = msg["seq"]
-        if seq in self._unacked:
-            del self._unacked[seq]
-        base_changed = False
-        while self._base < self._next_seq and self._base not in self._unacked:
-            self._base += 1
-            base_changed = True
-        if not self._unacked:
-            self._disarm_timer(ctx)
-        else:
-            if base_changed:
-                self._restart_timer(ctx)
-        self._try_send_pending(ctx)
 
-    def on_timer(self, timer_name: str, ctx: Context):
-        if timer_name != self._timer:
-            return
-        self._timer_active = False
-        if not self._unacked:
-            return
-        seq = self._base
-        if seq in self._unacked:
-            self._send_data(seq, self._unacked[seq], ctx)
-        self._arm_timer(ctx)
+BLOOM_BITS = 1024
+BLOOM_ROTATE = BLOOM_BITS // 8
 
 
 class ExactlyOnceReceiver(Process):
     def __init__(self, proc_id: str):
-        self._id = proc_id
-        self._next_seq = 1
-        self._win = 32
-        self._head = 0
-        self._seen = bytearray(self._win)
+        self._id: str = proc_id
+        self._next_seq: int = 1
+        self._seen_mask: int = 0
+        self._bloom: int = 0
+        self._bloom_prev: int = 0
+        self._bloom_count: int = 0
+        self._ack_pending: bool = False
+        self._ack_to: Optional[str] = None
 
     def on_local_message(self, msg: Message, ctx: Context):
         pass
 
-    def _advance(self):
-        self._head = (self._head + 1) % self._win
-        self._next_seq += 1
-        tail = (self._head + self._win - 1) % self._win
-        self._seen[tail] = 0
-
-    def _ensure_window(self, offset: int):
-        if offset < self._win:
-            return
-        new_win = self._win
-        while offset >= new_win and new_win < 1024:
-            new_win *= 2
-        if offset >= new_win:
-            new_win = offset + 1
-        new_seen = bytearray(new_win)
-        for d in range(min(self._win, new_win)):
-            new_seen[d] = self._seen[(self._head + d) % self._win]
-        self._win = new_win
-        self._seen = new_seen
-        self._head = 0
+    @staticmethod
+    def _bloom_bits(seq: int) -> int:
+        return (
+            2 ** ((seq * 2654435761) & (BLOOM_BITS - 1))
+            | 2 ** ((seq * 40503) & (BLOOM_BITS - 1))
+            | 2 ** ((seq * 2246822519) & (BLOOM_BITS - 1))
+        )
+
+    def _remember(self, seq: int):
+        self._bloom |= self._bloom_bits(seq)
+        self._bloom_count += 1
+        if self._bloom_count >= BLOOM_ROTATE:
+            self._bloom_prev = self._bloom
+            self._bloom = 0
+            self._bloom_count = 0
+
+    def _recently_delivered(self, seq: int) -> bool:
+        bits = self._bloom_bits(seq)
+        return (self._bloom | self._bloom_prev) & bits == bits
+
+    def _advance(self) -> int:
+        if not self._seen_mask & 1:
+            return 0
+        low_zero = (self._seen_mask + 1) & ~self._seen_mask
+        run = low_zero.bit_length() - 1
+        self._next_seq += run
+        self._seen_mask //= low_zero
+        return run
+
+    def _send_cumulative_ack(self, sender: str, ctx: Context):
+        if self._ack_pending:
+            ctx.cancel_timer(ACK_DELAY_TIMER)
+            self._ack_pending = False
+        ctx.send(Message(CACK, {"seq": self._next_seq - 1}), sender)
 
     def on_message(self, msg: Message, sender: str, ctx: Context):
-        if msg.type != "DATA":
+        if msg.type != DATA:
             return
         seq = msg["seq"]
         text = msg["text"]
         if seq < self._next_seq:
-            ctx.send(Message("ACK", {"seq": seq}), sender)
+            if self._recently_delivered(seq):
+                ctx.send(Message(ACK, {"seq": seq}), sender)
             return
-        offset = seq - self._next_seq
-        self._ensure_window(offset)
-        if offset == 0:
-            ctx.send_local(Message("MESSAGE", {"text": text}))
-            self._advance()
-            while self._seen[self._head] == 1:
-                self._seen[self._head] = 0
-                self._advance()
-        else:
-            idx = (self._head + offset) % self._win
-            if self._seen[idx] == 0:
-                self._seen[idx] = 1
-                ctx.send_local(Message("MESSAGE", {"text": text}))
-        ctx.send(Message("ACK", {"seq": seq}), sender)
+        bit = 2 ** (seq - self._next_seq)
+        if self._seen_mask & bit:
+            ctx.send(Message(ACK, {"seq": seq}), sender)
+            return
+        self._seen_mask |= bit
+        ctx.send_local(Message(MESSAGE, {"text": text}))
+        self._remember(seq)
+        run = self._advance()
+        if run == 0:
+            ctx.send(Message(ACK, {"seq": seq}), sender)
+        elif run > 1:
+            self._send_cumulative_ack(sender, ctx)
+        elif not self._ack_pending:
+            self._ack_pending = True
+            self._ack_to = sender
+            ctx.set_timer_once(ACK_DELAY_TIMER, 0.05)
 
     def on_timer(self, timer_name: str, ctx: Context):
-        pass
+        if timer_name != ACK_DELAY_TIMER or not self._ack_pending:
+            return
+        self._ack_pending = False
+        ctx.send(Message(CACK, {"seq": self._next_seq - 1}), self._ack_to)
 
 
 # EXACTLY ONCE + ORDERED -----------------------------------------------------------------------------------------------
 
 
-class ExactlyOnceOrderedSender(Process):
-    def __init__(self, proc_id: str, receiver_id: str):
-        self._id = proc_id
-        self._receiver = receiver_id
-        self._next_seq = 1
-        self._base = 1
-        self._unacked = {}
-        self._pending = []
-        self._pending_idx = 0
-        self._window = 4
-        self._timeout = 6.5
-        self._timer = "rtx"
-        self._timer_active = False
-
-    def _has_window_space(self) -> bool:
-        return self._next_seq < self._base + self._window
-
-    def _arm_timer(self, ctx: Context):
-        ctx.set_timer_once(self._timer, self._timeout)
-        self._timer_active = True
-
-    def _disarm_timer(self, ctx: Context):
-        if self._timer_active:
-            ctx.cancel_timer(self._timer)
-            self._timer_active = False
-
-    def _restart_timer(self, ctx: Context):
-        self._disarm_timer(ctx)
-        self._arm_timer(ctx)
-
-    def _send_data(self, seq: int, text: str, ctx: Context):
-        ctx.send(Message("DATA", {"seq": seq, "text": text}), self._receiver)
-
-    def _try_send_pending(self, ctx: Context):
-        while self._pending_idx < len(self._pending) and self._has_window_space():
-            text = self._pending[self._pending_idx]
-            self._pending_idx += 1
-            seq = self._next_seq
-            self._next_seq += 1
-            was_empty = not self._unacked
-            self._unacked[seq] = text
-            self._send_data(seq, text, ctx)
-            if was_empty:
-                self._restart_timer(ctx)
-        if self._pending_idx > 0 and self._pending_idx * 2 >= len(self._pending):
-            self._pending = self._pending[self._pending_idx :]
-            self._pending_idx = 0
-
-    def on_local_message(self, msg: Message, ctx: Context):
-        if msg.type != "MESSAGE":
-            return
-        text = msg["text"]
-        if self._has_window_space():
-            seq = self._next_seq
-            self._next_seq += 1
-            was_empty = not self._unacked
-            self._unacked[seq] = text
-            self._send_data(seq, text, ctx)
-            if was_empty:
-                self._restart_timer(ctx)
-        else:
-            self._pending.append(text)
-
-    def on_message(self, msg: Message, sender: str, ctx: Context):
-        if msg.type != "ACK":
-            return
-        seq = msg["seq"]
-        if seq in self._unacked:
-            del self._unacked[seq]
-        base_changed = False
-        while self._base < self._next_seq and self._base not in self._unacked:
-            self._base += 1
-            base_changed = True
-        if not self._unacked:
-            self._disarm_timer(ctx)
-        else:
-            if base_changed:
-                self._restart_timer(ctx)
-        self._try_send_pending(ctx)
-
-    def on_timer(self, timer_name: str, ctx: Context):
-        if timer_name != self._timer:
-            return
-        self._timer_active = False
-        if not self._unacked:
-            return
-        seq = self._base
-        if seq in self._unacked:
-            self._send_data(seq, self._unacked[seq], ctx)
-        self._arm_timer(ctx)
+class ExactlyOnceOrderedSender(_WindowedSender):
+    WINDOW = 4
 
 
 class ExactlyOnceOrderedReceiver(Process):
     def __init__(self, proc_id: str):
-        self._id = proc_id
-        self._next_seq = 1
-        self._buffer = {}
+        self._id: str = proc_id
+        self._next_seq: int = 1
+        self._buffer: Dict[int, str] = {}
 
     def on_local_message(self, msg: Message, ctx: Context):
         pass
 
     def _deliver(self, text: str, ctx: Context):
-        ctx.send_local(Message("MESSAGE", {"text": text}))
+        ctx.send_local(Message(MESSAGE, {"text": text}))
 
     def _flush(self, ctx: Context):
         while self._next_seq in self._buffer:
@@ -453,12 +343,12 @@ class ExactlyOnceOrderedReceiver(Process):
             self._next_seq += 1
 
     def on_message(self, msg: Message, sender: str, ctx: Context):
-        if msg.type != "DATA":
+        if msg.type != DATA:
             return
         seq = msg["seq"]
         text = msg["text"]
         if seq < self._next_seq:
-            ctx.send(Message("ACK", {"seq": seq}), sender)
+            ctx.send(Message(ACK, {"seq": seq}), sender)
             return
         if seq == self._next_seq:
             self._deliver(text, ctx)
@@ -467,7 +357,7 @@ class ExactlyOnceOrderedReceiver(Process):
         else:
             if seq not in self._buffer:
                 self._buffer[seq] = text
-        ctx.send(Message("ACK", {"seq": seq}), sender)
+        ctx.send(Message(ACK, {"seq": seq}), sender)
 
     def on_timer(self, timer_name: str, ctx: Context):
         pass
@@ -1,76 +1,109 @@
-import copy
+import asyncio
 import json
 import os
-import threading
-import time
-from datetime import datetime, timezone
+import re
+from collections import deque
 from http import HTTPStatus
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from typing import List, Dict
+from typing import Deque, List, Dict, Tuple
 
 import google.protobuf.empty_pb2  # Empty
-import google.protobuf.json_format  # ParseDict, MessageToDict
+import google.protobuf.json_format  # Parse
 import grpc
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from messenger.proto import messenger_pb2
 from messenger.proto import messenger_pb2_grpc
 
 
+def _civil_from_days(days: int) -> Tuple[int, int, int]:
+    # days since 1970-01-01 -> proleptic Gregorian (y, m, d), H. Hinnant's algorithm
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (m <= 2), m, d
+
+
 def ts_to_str(ts) -> str:
-    dt = datetime.fromtimestamp(ts.seconds, tz=timezone.utc)
-    base = dt.strftime("%Y-%m-%dT%H:%M:%S")
-    return f"{base}.{ts.nanos:09d}Z"
+    days, rem = divmod(ts.seconds, 86400)
+    h, rem = divmod(rem, 3600)
+    mi, se = divmod(rem, 60)
+    y, mo, d = _civil_from_days(days)
+    return f"{y:04d}-{mo:02d}-{d:02d}T{h:02d}:{mi:02d}:{se:02d}.{ts.nanos:09d}Z"
 
 
 class PostBox:
     def __init__(self):
-        self._messages: List[Dict] = []
-        self._lock = threading.Lock()
+        self._messages: Deque[Dict] = deque()
 
     def collect_messages(self) -> List[Dict]:
-        with self._lock:
-            messages = copy.deepcopy(self._messages)
-            self._messages = []
-        return messages
+        messages = []
+        while True:
+            try:
+                messages.append(self._messages.popleft())
+            except IndexError:
+                return messages
 
     def put_message(self, message: Dict):
-        with self._lock:
-            self._messages.append(message)
-
+        self._messages.append(message)
 
-class MessageHandler(BaseHTTPRequestHandler):
-    _stub = None
-    _postbox: PostBox
 
-    def _read_content(self):
-        content_length = int(self.headers['Content-Length'])
-        bytes_content = self.rfile.read(content_length)
-        return bytes_content.decode('ascii')
+class MessageHandler:
+    def __init__(self, stub: messenger_pb2_grpc.MessengerServerStub, postbox: PostBox):
+        self._stub = stub
+        self._postbox = postbox
 
-    # noinspection PyPep8Naming
-    def do_POST(self):
-        if self.path == '/sendMessage':
-            response = self._send_message(self._read_content())
-        elif self.path == '/getAndFlushMessages':
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    return
+                request_line, _, headers = head.partition(b'\r\n')
+                parts = request_line.split()
+                if len(parts) != 3:
+                    writer.write(_http_response(HTTPStatus.BAD_REQUEST, b'', False))
+                    await writer.drain()
+                    return
+                method, path, version = parts
+                m = _CONTENT_LENGTH.search(headers)
+                content = await reader.readexactly(int(m.group(1))) if m else b''
+                keep_alive = version == b'HTTP/1.1' and _CONNECTION_CLOSE.search(headers) is None
+
+                writer.write(await self._dispatch(method, path, content, keep_alive))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: bytes, path: bytes, content: bytes, keep_alive: bool) -> bytes:
+        if method != b'POST':
+            return _http_response(HTTPStatus.NOT_IMPLEMENTED, b'', keep_alive)
+        if path == b'/sendMessage':
+            response = await self._send_message(content)
+        elif path == b'/getAndFlushMessages':
             response = self._get_messages()
         else:
-            self.send_error(HTTPStatus.NOT_IMPLEMENTED)
-            self.end_headers()
-            return
-
-        response_bytes = json.dumps(response).encode('ascii')
-        self.send_response(HTTPStatus.OK)
-        self.send_header('Content-Length', str(len(response_bytes)))
-        self.end_headers()
-        self.wfile.write(response_bytes)
+            return _http_response(HTTPStatus.NOT_IMPLEMENTED, b'', keep_alive)
 
-    def _send_message(self, content: str) -> dict:
-        json_request = json.loads(content)
+        return _http_response(HTTPStatus.OK, json.dumps(response).encode('ascii'), keep_alive)
 
+    async def _send_message(self, content: bytes) -> dict:
         req = messenger_pb2.SendMessageRequest()
-        google.protobuf.json_format.ParseDict(json_request, req)
+        google.protobuf.json_format.Parse(content, req)
 
-        resp = self._stub.SendMessage(req)
+        resp = await self._stub.SendMessage(req)
 
         return {'sendTime': ts_to_str(resp.send_time)}
 
@@ -78,46 +111,67 @@ class MessageHandler(BaseHTTPRequestHandler):
         return self._postbox.collect_messages()
 
 
-def main():
+_CONTENT_LENGTH = re.compile(rb'^content-length:[ \t]*(\d+)', re.IGNORECASE | re.MULTILINE)
+_CONNECTION_CLOSE = re.compile(rb'^connection:[ \t]*close', re.IGNORECASE | re.MULTILINE)
+
+
+def _http_response(status: HTTPStatus, body: bytes, keep_alive: bool) -> bytes:
+    head = f'HTTP/1.1 {status.value} {status.phrase}\r\nContent-Length: {len(body)}\r\n'
+    if body:
+        head += 'Content-Type: application/json\r\n'
+    if not keep_alive:
+        head += 'Connection: close\r\n'
+    return (head + '\r\n').encode('ascii') + body
+
+
+async def consume(stub: messenger_pb2_grpc.MessengerServerStub, postbox: PostBox, ready: asyncio.Event):
+    while True:
+        try:
+            call = stub.ReadMessages(google.protobuf.empty_pb2.Empty())
+            try:
+                await call.initial_metadata()
+                ready.set()
+            except Exception:
+                pass
+            async for msg in call:
+                postbox.put_message({'author': msg.author, 'text': msg.text, 'sendTime': ts_to_str(msg.send_time)})
+        except grpc.RpcError:
+            await asyncio.sleep(0.2)
+
+
+async def run_server():
     grpc_server_address = os.environ.get('MESSENGER_SERVER_ADDR', 'localhost:51075')
 
-    channel = grpc.insecure_channel(grpc_server_address)
+    channel = grpc.aio.insecure_channel(grpc_server_address)
     try:
-        grpc.channel_ready_future(channel).result(timeout=15)
-    except Exception:
+        await asyncio.wait_for(channel.channel_ready(), timeout=15)
+    except asyncio.TimeoutError:
         pass
     stub = messenger_pb2_grpc.MessengerServerStub(channel)
 
     postbox = PostBox()
 
-    ready = threading.Event()
+    ready = asyncio.Event()
+    consumer = asyncio.create_task(consume(stub, postbox, ready))
+    try:
+        await asyncio.wait_for(ready.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        pass
 
-    def consume():
-        while True:
-            try:
-                call = stub.ReadMessages(google.protobuf.empty_pb2.Empty())
-                try:
-                    call.initial_metadata()
-                    ready.set()
-                except Exception:
-                    pass
-                for msg in call:
-                    postbox.put_message({'author': msg.author, 'text': msg.text, 'sendTime': ts_to_str(msg.send_time)})
-            except grpc.RpcError:
-                time.sleep(0.2)
-
-    t = threading.Thread(target=consume, daemon=True)
-    t.start()
-    ready.wait(timeout=10)
-
-    MessageHandler._stub = stub
-    MessageHandler._postbox = postbox
+    handler = MessageHandler(stub, postbox)
 
     http_port = os.environ.get('MESSENGER_HTTP_PORT', '8080')
-    http_server_address = ('0.0.0.0', int(http_port))
+    httpd = await asyncio.start_server(handler.handle, '0.0.0.0', int(http_port))
+    async with httpd:
+        await httpd.serve_forever()
+    consumer.cancel()
 
-    httpd = HTTPServer(http_server_address, MessageHandler)
-    httpd.serve_forever()
+
+def main():
+    if uvloop is not None:
+        uvloop.run(run_server())
+    else:
+        asyncio.run(run_server())
 
 
 if __name__ == '__main__':
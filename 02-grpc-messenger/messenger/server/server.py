@@ -1,8 +1,6 @@
+import asyncio
 import os
-import queue
-import threading
 import time
-from concurrent import futures
 
 import grpc
 from google.protobuf import empty_pb2
@@ -11,14 +9,14 @@ from google.protobuf import timestamp_pb2
 from messenger.proto import messenger_pb2
 from messenger.proto import messenger_pb2_grpc
 
-
 class MessengerService(messenger_pb2_grpc.MessengerServerServicer):
     def __init__(self):
-        self._lock = threading.Lock()
-        self._subs = []
+        # everything runs on one event loop, and SendMessage does not await
+        # between taking a timestamp and fanning out, so no lock is needed
+        self._subs = {}
         self._last_ns = 0
 
-    def _next_timestamp_locked(self) -> timestamp_pb2.Timestamp:
+    def _next_timestamp(self) -> timestamp_pb2.Timestamp:
         ns = time.time_ns()
         if ns <= self._last_ns:
             ns = self._last_ns + 1
@@ -28,41 +26,36 @@ class MessengerService(messenger_pb2_grpc.MessengerServerServicer):
         ts.nanos = ns % 1_000_000_000
         return ts
 
-    def SendMessage(self, request, context):
-        with self._lock:
-            ts = self._next_timestamp_locked()
-            msg = messenger_pb2.ChatMessage(author=request.author, text=request.text, send_time=ts)
-            subs = list(self._subs)
-            for q in subs:
-                m = messenger_pb2.ChatMessage()
-                m.CopyFrom(msg)
-                q.put(m)
+    async def SendMessage(self, request, context):
+        ts = self._next_timestamp()
+        msg = messenger_pb2.ChatMessage(author=request.author, text=request.text, send_time=ts)
+        for q in self._subs.values():
+            q.put_nowait(msg)
         return messenger_pb2.SendMessageResponse(send_time=ts)
 
-    def ReadMessages(self, request: empty_pb2.Empty, context):
-        q = queue.Queue()
-        with self._lock:
-            self._subs.append(q)
+    async def ReadMessages(self, request: empty_pb2.Empty, context):
+        q = asyncio.Queue()
+        key = id(q)
+        self._subs[key] = q
         try:
-            while context.is_active():
-                try:
-                    msg = q.get(timeout=1.0)
-                except queue.Empty:
-                    continue
-                yield msg
+            await context.send_initial_metadata(())
+            while True:
+                yield await q.get()
         finally:
-            with self._lock:
-                if q in self._subs:
-                    self._subs.remove(q)
+            self._subs.pop(key, None)
 
 
-def main():
+async def serve():
     port = os.environ.get("MESSENGER_SERVER_PORT", "51075")
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=32))
+    server = grpc.aio.server()
     messenger_pb2_grpc.add_MessengerServerServicer_to_server(MessengerService(), server)
     server.add_insecure_port(f"0.0.0.0:{port}")
-    server.start()
-    server.wait_for_termination()
+    await server.start()
+    await server.wait_for_termination()
+
+
+def main():
+    asyncio.run(serve())
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
 import dataclasses
+import re
+import sys
 import typing as t
 
 
@@ -12,55 +14,34 @@ class HTTPRequest:
 
     @staticmethod
     def from_bytes(data: bytes) -> "HTTPRequest":
-        if b"\r\n\r\n" in data:
-            head, _ = data.split(b"\r\n\r\n", 1)
-        elif b"\n\n" in data:
-            head, _ = data.split(b"\n\n", 1)
-        else:
-            head = data
-
-        lines = head.splitlines()
-        if not lines:
+        end = _head_end(data)
+        if not end:
             raise ValueError("empty request")
 
-        req_line = lines[0].decode("latin-1").strip()
-        parts = req_line.split()
-        if len(parts) != 3:
+        m = _REQUEST_LINE.match(data, 0, end)
+        if m is None:
             raise ValueError("bad request line")
 
-        method, target, version = parts
+        method, target, version = (g.decode("latin-1") for g in m.groups())
+        # interned so callers comparing request.method against the GET/POST/... constants
+        # below hit the identity fast path (server.py parses its request line itself)
+        method = sys.intern(method)
         if version.startswith("HTTP/"):
-            version = version.split("/", 1)[1]
+            version = version[5:]
 
         target = target.split("#", 1)[0]
-        if "?" in target:
-            path, query = target.split("?", 1)
-        else:
-            path, query = target, ""
-
+        path, _, query = target.partition("?")
         if not path:
             path = "/"
 
-        parameters: t.Dict[str, str] = {}
-        if query:
-            for chunk in query.split("&"):
-                if not chunk:
-                    continue
-                if "=" in chunk:
-                    k, v = chunk.split("=", 1)
-                else:
-                    k, v = chunk, ""
-                parameters[k] = v
-
-        headers: t.Dict[str, str] = {}
-        for raw in lines[1:]:
-            s = raw.decode("latin-1").strip()
-            if not s:
-                continue
-            if ":" not in s:
-                continue
-            k, v = s.split(":", 1)
-            headers[k.strip()] = v.strip()
+        parameters: t.Dict[str, str] = dict(
+            chunk.partition("=")[::2] for chunk in query.split("&") if chunk
+        )
+
+        headers: t.Dict[str, str] = {
+            k.strip().decode("latin-1"): v.strip().decode("latin-1")
+            for k, v in _HEADER.findall(data, m.end(), end)
+        }
 
         return HTTPRequest(
             method=method,
@@ -78,11 +59,8 @@ class HTTPRequest:
                 items.append(f"{k}={v}")
             query = "?" + "&".join(items)
 
-        start = f"{self.method} {self.path}{query} HTTP/{self.version}".encode("latin-1") + CRLF
-        hdrs = b"".join(
-            (f"{k}: {v}".encode("latin-1") + CRLF) for k, v in self.headers.items()
-        )
-        return start + hdrs + CRLF
+        start = f"{self.method} {self.path}{query} HTTP/{self.version}\r\n".encode("latin-1")
+        return b"".join([start, *_encode_headers(self.headers), CRLF])
 
 
 @dataclasses.dataclass
@@ -93,39 +71,42 @@ class HTTPResponse:
 
     @staticmethod
     def from_bytes(data: bytes) -> "HTTPResponse":
-        lines = data.splitlines()
-        if not lines:
+        end = _head_end(data)
+        if not end:
             raise ValueError("empty response")
 
-        status_line = lines[0].decode("latin-1").strip()
-        parts = status_line.split()
-        if len(parts) < 2:
+        m = _STATUS_LINE.match(data, 0, end)
+        if m is None:
             raise ValueError("bad status line")
 
-        ver = parts[0]
+        ver, status = (g.decode("latin-1") for g in m.groups())
         if ver.startswith("HTTP/"):
-            ver = ver.split("/", 1)[1]
-
-        status = parts[1]
-        headers: t.Dict[str, str] = {}
-        for raw in lines[1:]:
-            s = raw.decode("latin-1").strip()
-            if not s:
-                break
-            if ":" not in s:
-                continue
-            k, v = s.split(":", 1)
-            headers[k.strip()] = v.strip()
+            ver = ver[5:]
+
+        headers: t.Dict[str, str] = {
+            k.strip().decode("latin-1"): v.strip().decode("latin-1")
+            for k, v in _HEADER.findall(data, m.end(), end)
+        }
 
         return HTTPResponse(version=ver, status=status, headers=headers)
 
     def to_bytes(self) -> bytes:
-        reason = HTTP_REASON_BY_STATUS.get(self.status, "")
-        start = f"HTTP/{self.version} {self.status} {reason}".encode("latin-1") + CRLF
-        hdrs = b"".join(
-            (f"{k}: {v}".encode("latin-1") + CRLF) for k, v in self.headers.items()
-        )
-        return start + hdrs + CRLF
+        start = _STATUS_LINES.get(self.status) if self.version == HTTP_VERSION else None
+        if start is None:
+            reason = HTTP_REASON_BY_STATUS.get(self.status, "")
+            start = f"HTTP/{self.version} {self.status} {reason}\r\n".encode("latin-1")
+        return b"".join([start, *_encode_headers(self.headers), CRLF])
+
+
+def _head_end(data: bytes) -> int:
+    end = data.find(b"\r\n\r\n")
+    if end == -1:
+        end = data.find(b"\n\n")
+    return len(data) if end == -1 else end
+
+
+def _encode_headers(headers: t.Dict[str, str]) -> t.List[bytes]:
+    return [f"{k}: {v}\r\n".encode("latin-1") for k, v in headers.items()]
 
 
 # Common HTTP strings and constants
@@ -135,23 +116,29 @@ CR = b'\r'
 LF = b'\n'
 CRLF = CR + LF
 
+_REQUEST_LINE = re.compile(rb"[ \t]*(\S+)[ \t]+(\S+)[ \t]+(\S+)[ \t]*(?:\r?\n|\r|$)")
+_STATUS_LINE = re.compile(rb"[ \t]*(\S+)[ \t]+(\S+)[^\r\n]*(?:\r?\n|\r|$)")
+# header name/value are stripped as bytes and decoded once; trimming inside
+# the pattern with lazy groups was measured ~2x slower than bytes.strip()
+_HEADER = re.compile(rb"^([^:\r\n]*):([^\r\n]*)\r?$", re.MULTILINE)
+
 HTTP_VERSION = "1.1"
 
-OPTIONS = 'OPTIONS'
-GET = 'GET'
-HEAD = 'HEAD'
-POST = 'POST'
-PUT = 'PUT'
-DELETE = 'DELETE'
+OPTIONS = sys.intern('OPTIONS')
+GET = sys.intern('GET')
+HEAD = sys.intern('HEAD')
+POST = sys.intern('POST')
+PUT = sys.intern('PUT')
+DELETE = sys.intern('DELETE')
 
-METHODS = [
+METHODS = frozenset([
     OPTIONS,
     GET,
     HEAD,
     POST,
     PUT,
     DELETE,
-]
+])
 
 HEADER_HOST = "Host"
 HEADER_CONTENT_LENGTH = "Content-Length"
@@ -217,3 +204,8 @@ HTTP_REASON_BY_STATUS = {
     "504": "Gateway Time-out",
     "505": "HTTP Version not supported",
 }
+
+_STATUS_LINES = {
+    status: f"HTTP/{HTTP_VERSION} {status} {reason}\r\n".encode("latin-1")
+    for status, reason in HTTP_REASON_BY_STATUS.items()
+}
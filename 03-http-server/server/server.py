@@ -1,18 +1,34 @@
-import datetime
-import gzip
+import functools
+import hashlib
+import itertools
 import logging
 import mimetypes
 import os
 import pathlib
 import posixpath
 import shutil
+import signal
 from dataclasses import dataclass
 from socketserver import StreamRequestHandler
 import typing as t
 import click
+import errno
 import socket
 import stat as statmod
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # ISA-L deflate/crc32 is SIMD-accelerated and a drop-in for the stdlib zlib module
+    from isal import isal_zlib as zlib
+    from isal.isal_zlib import ISAL_BEST_COMPRESSION as GZIP_MAX_LEVEL
+except ImportError:
+    import zlib
+    GZIP_MAX_LEVEL = 9
 
 from http_messages import (
     HTTP_VERSION,
@@ -41,43 +57,66 @@ from http_messages import (
     HTTP_REASON_BY_STATUS,
 )
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get("SERVER_LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+mimetypes.init()
+
 SERVER_NAME = "hse-http-file-server"
 
+# the request line and headers stay bytes (HTTP tokens are ASCII); headers are
+# looked up in the lower-cased dict from _read_headers
+_HDR_HOST_LC = HEADER_HOST.lower().encode("ascii")
+_HDR_CONTENT_LENGTH_LC = HEADER_CONTENT_LENGTH.lower().encode("ascii")
+_HDR_ACCEPT_ENCODING_LC = HEADER_ACCEPT_ENCODING.lower().encode("ascii")
+_HDR_CREATE_DIRECTORY_LC = HEADER_CREATE_DIRECTORY.lower().encode("ascii")
+_HDR_REMOVE_DIRECTORY_LC = HEADER_REMOVE_DIRECTORY.lower().encode("ascii")
+_GZIP_LC = GZIP.lower().encode("ascii")
+
+# raw method token -> the str constant used as the _METHOD_HANDLERS key
+_METHODS_BY_TOKEN = {m.encode("ascii"): m for m in METHODS}
+_HTTP_VERSION_B = HTTP_VERSION.encode("ascii")
+
+IO_CHUNK = 64 * 1024
+BODY_CHUNK = 256 * 1024
+
+# deflate with a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 
 @dataclass
 class HTTPServer:
     server_address: t.Tuple[str, int]
     socket: socket.socket
     server_domain: str
-    working_directory: pathlib.Path
-
+    working_directory: pathlib.Path  # already resolved
+    gzip_level: int = 1
+    gzip_cache: t.Optional["GzipCache"] = None
 
-def _lower_headers(headers: t.Dict[str, str]) -> t.Dict[str, str]:
-    return {k.strip().lower(): v.strip() for k, v in headers.items()}
+    @functools.cached_property
+    def server_domain_bytes(self) -> bytes:
+        return self.server_domain.encode("latin-1")
 
 
-def _parse_bool(v: str) -> bool:
-    return v.strip().lower() == "true"
+def _parse_bool(v: bytes) -> bool:
+    return v.strip().lower() == b"true"
 
 
-def _host_only(host_header: str) -> str:
+def _host_only(host_header: bytes) -> bytes:
     host_header = host_header.strip()
     if not host_header:
-        return ""
-    if ":" in host_header:
-        return host_header.split(":", 1)[0]
+        return b""
+    if b":" in host_header:
+        return host_header.split(b":", 1)[0]
     return host_header
 
 
-def _wants_gzip(headers_lc: t.Dict[str, str]) -> bool:
-    ae = headers_lc.get(HEADER_ACCEPT_ENCODING.lower(), "")
+def _wants_gzip(headers_lc: t.Dict[bytes, bytes]) -> bool:
+    ae = headers_lc.get(_HDR_ACCEPT_ENCODING_LC, b"")
     if not ae:
         return False
-    parts = [p.strip().lower() for p in ae.split(",")]
-    return GZIP.lower() in parts
+    parts = [p.strip().lower() for p in ae.split(b",")]
+    return _GZIP_LC in parts
 
 
 def _safe_resolve(root: pathlib.Path, url_path: str) -> pathlib.Path:
@@ -92,254 +131,526 @@ def _safe_resolve(root: pathlib.Path, url_path: str) -> pathlib.Path:
     if rel == ".." or rel.startswith("../"):
         raise ValueError("bad path")
 
-    root_resolved = root.resolve()
-    target = (root_resolved / rel).resolve()
-    if not target.is_relative_to(root_resolved):
+    # root is resolved once at startup, so only the target needs a realpath
+    root_str = str(root)
+    target = os.path.realpath(os.path.join(root_str, rel))
+    if target != root_str and not target.startswith(root_str.rstrip(os.sep) + os.sep):
         raise ValueError("bad path")
 
-    return target
+    return pathlib.Path(target)
 
 
-def _guess_content_type(p: pathlib.Path) -> str:
-    tpe, _ = mimetypes.guess_type(str(p))
+# same errors pathlib's exists()/is_dir() treat as "no such path"
+_MISSING_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP)
+
+
+def _stat_or_none(p: pathlib.Path) -> t.Optional[os.stat_result]:
+    # one stat() instead of exists() + is_dir() + stat(), each of which is a syscall
+    try:
+        return os.stat(p)
+    except OSError as e:
+        if e.errno not in _MISSING_ERRNOS:
+            raise
+        return None
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=2048)
+def _content_type_for_suffixes(suffixes: str) -> str:
+    tpe, _ = mimetypes.guess_type("x" + suffixes)
     if not tpe:
         return APPLICATION_OCTET_STREAM
     return tpe
 
 
-def _format_dir_listing(dir_path: pathlib.Path) -> str:
-    lines: list[str] = []
-    entries = sorted(dir_path.iterdir(), key=lambda x: x.name)
+def _guess_content_type(p: pathlib.Path) -> str:
+    # keyed on the whole suffix chain, not just the last one: "a.tar.gz" is
+    # application/x-tar, while ".gz" alone is only an encoding
+    return _content_type_for_suffixes("".join(p.suffixes))
 
+
+@functools.lru_cache(maxsize=256)
+def _filemode(mode: int) -> str:
+    return statmod.filemode(mode)
+
+
+@functools.lru_cache(maxsize=8192)
+def _fmt_mtime(sec: int) -> str:
+    # files in one directory are often written within the same second
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))
+
+
+def _iter_dir_listing(dir_path: pathlib.Path) -> t.Iterator[bytes]:
+    """Yield the encoded listing in chunks of about IO_CHUNK bytes.
+
+    Lines are batched because a compressobj.compress() call per short line,
+    with a socket write each, is several times slower than one per chunk.
+    """
+    # scandir yields DirEntry objects with the name straight from readdir, so no
+    # pathlib.Path is built per entry. On Linux readdir only carries d_type (which
+    # would make is_dir() free), so entry.stat() below is still one lstat each
+    with os.scandir(dir_path) as it:
+        entries = sorted(it, key=lambda x: x.name)
+
+    lines: list[str] = []
+    pending = 0
     for entry in entries:
-        st = entry.lstat()
-        perm = statmod.filemode(st.st_mode)
-        user = str(st.st_uid)
-        group = str(st.st_gid)
-        size = st.st_size
-        sec = st.st_mtime_ns // 1_000_000_000
-        dt = datetime.datetime.fromtimestamp(sec).strftime("%Y-%m-%d %H:%M:%S")
-        lines.append(f"{perm} {user} {group} {size} {dt} {entry.name}")
+        st = entry.stat(follow_symlinks=False)
+        perm = _filemode(st.st_mode)
+        dt = _fmt_mtime(st.st_mtime_ns // 1_000_000_000)
+        line = f"{perm} {st.st_uid} {st.st_gid} {st.st_size} {dt} {entry.name}\n"
+        lines.append(line)
+        pending += len(line)
+        if pending >= IO_CHUNK:
+            yield "".join(lines).encode("utf-8", "replace")
+            lines.clear()
+            pending = 0
+
+    if lines:
+        yield "".join(lines).encode("utf-8", "replace")
+
+
+@functools.lru_cache(maxsize=256)
+def _head_prefix(status: str, content_type: str) -> bytes:
+    # status line + Content-Type, which every response starts with
+    reason = HTTP_REASON_BY_STATUS.get(status, "")
+    return f"HTTP/{HTTP_VERSION} {status} {reason}\r\n{HEADER_CONTENT_TYPE}: {content_type}\r\n".encode("latin-1")
+
+
+_HEAD_SUFFIX = f"{HEADER_SERVER}: {SERVER_NAME}\r\nConnection: close\r\n\r\n".encode("latin-1")
+
+# complete responses without a body (POST/PUT/DELETE successes); no Content-Type
+# since there is nothing to describe
+_EMPTY_RESPONSES: t.Dict[str, bytes] = {
+    status: f"HTTP/{HTTP_VERSION} {status} {reason}\r\n{HEADER_CONTENT_LENGTH}: 0\r\n".encode("latin-1") + _HEAD_SUFFIX
+    for status, reason in HTTP_REASON_BY_STATUS.items()
+}
+
+
+def _response_head(status: str, content_type: str, headers: t.Dict[str, str]) -> bytes:
+    lines = [_head_prefix(status, content_type)]
+    lines.extend(f"{k}: {v}\r\n".encode("latin-1") for k, v in headers.items())
+    lines.append(_HEAD_SUFFIX)
+    return b"".join(lines)
+
+
+_thread_local = threading.local()
+
+
+def _io_buffer() -> memoryview:
+    # one buffer per pool thread, reused by every request that thread serves
+    buf = getattr(_thread_local, "io_buffer", None)
+    if buf is None:
+        buf = _thread_local.io_buffer = memoryview(bytearray(BODY_CHUNK))
+    return buf
+
+
+def _iter_file_chunks(f) -> t.Iterator[memoryview]:
+    # not mmap: a concurrent PUT truncating the file would SIGBUS the whole server
+    buf = _io_buffer()
+    while True:
+        got = f.readinto(buf)
+        if not got:
+            return
+        yield buf[:got]
+
+
+# like git's racily clean index entries: a file changed less than this long ago
+# may change again without its timestamps moving on a coarse-grained filesystem
+GZIP_CACHE_RACY_NS = 1_000_000_000
+
+
+class GzipCacheFill:
+    """A cache entry being written while the same gzip stream goes to the client.
+
+    Write errors (a full disk, say) only drop the entry, never the response.
+    """
+
+    def __init__(self, key: str, tmp: pathlib.Path, f: t.BinaryIO):
+        self.key = key
+        self.tmp = tmp
+        self._f = f
+        self.ok = True
+
+    def write(self, data: bytes) -> None:
+        if self.ok:
+            try:
+                self._f.write(data)
+            except OSError:
+                self.ok = False
+
+    def close(self) -> None:
+        try:
+            self._f.close()
+        except OSError:
+            self.ok = False
+
+
+class GzipCache:
+    """Compressed copies of served files, kept outside the working directory.
+
+    Entries are keyed on path, inode, mtime, ctime, size and level, so a changed
+    file just misses and its stale entry ages out. A miss is streamed to the
+    client and written to the cache at the same time (GzipCacheFill), so the
+    first response is not held back by compressing the whole file up front.
+    Least recently used entries are evicted once the total compressed size
+    passes max_bytes. The temporary directory is removed by close().
+    """
+
+    def __init__(self, max_bytes: int, level: int):
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="gzip-cache-")
+        self._dir = pathlib.Path(self._tmpdir.name)
+        self._max_bytes = max_bytes
+        self._level = level
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+
+    def key(self, fs_path: pathlib.Path, st: os.stat_result) -> t.Optional[str]:
+        """Return the cache key for this version of the file, or None if it should not be cached."""
+        if st.st_size > self._max_bytes:
+            return None
+        if time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) < GZIP_CACHE_RACY_NS:
+            return None
+
+        ident = f"{fs_path}\0{st.st_ino}\0{st.st_mtime_ns}\0{st.st_ctime_ns}\0{st.st_size}\0{self._level}"
+        return hashlib.sha1(ident.encode("utf-8", "surrogateescape")).hexdigest()
+
+    def open(self, key: str) -> t.Optional[t.BinaryIO]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            # opened under the lock, so a concurrent eviction can only unlink it after
+            return open(self._dir / f"{key}.gz", "rb")
+
+    def start(self, key: str) -> t.Optional[GzipCacheFill]:
+        tmp = self._dir / f"{key}.{threading.get_ident()}.tmp"
+        try:
+            f = open(tmp, "wb")
+        except OSError:
+            return None
+        return GzipCacheFill(key, tmp, f)
+
+    def finish(self, fill: GzipCacheFill, complete: bool) -> None:
+        """Publish a fill, or drop it if the stream or any write to it failed."""
+        fill.close()
+        size = None
+        if fill.ok and complete:
+            try:
+                size = fill.tmp.stat().st_size
+            except OSError:
+                pass
+        if size is None:
+            fill.tmp.unlink(missing_ok=True)
+            return
+
+        key = fill.key
+        with self._lock:
+            # replaced under the lock, or an eviction could unlink the path
+            # between the rename and the registration
+            os.replace(fill.tmp, self._dir / f"{key}.gz")
+            if key not in self._entries:
+                self._entries[key] = size
+                self._total += size
+            while self._total > self._max_bytes and next(iter(self._entries)) != key:
+                old, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                (self._dir / f"{old}.gz").unlink(missing_ok=True)
 
-    if not lines:
-        return ""
-    return "\n".join(lines) + "\n"
+    def close(self) -> None:
+        self._tmpdir.cleanup()
 
 
 class HTTPHandler(StreamRequestHandler):
     server: HTTPServer
 
+    # 64 KiB buffered rfile/wfile instead of the 8 KiB / unbuffered defaults
+    rbufsize = IO_CHUNK
+    wbufsize = IO_CHUNK
+
+    def setup(self) -> None:
+        super().setup()
+        # no Nagle delays; while corked the kernel only sends full segments,
+        # so the head and the start of the body (even via sendfile) share packets
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, "TCP_CORK"):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+    def finish(self) -> None:
+        super().finish()
+        if hasattr(socket, "TCP_CORK"):
+            try:
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            except OSError:
+                pass
+
     # Use self.rfile and self.wfile to interact with the client
     # Access domain and working directory with self.server.{attr}
     def handle(self) -> None:
         first_line = self.rfile.readline()
-        logger.info(f"Handle connection from {self.client_address}, first_line {first_line}")
+        # per-request, so debug and %-style: nothing is formatted unless it is emitted
+        logger.debug("Handle connection from %s, first_line %r", self.client_address, first_line)
 
         if not first_line:
             return
 
-        req_line = first_line.decode("latin-1").strip("\r\n")
-        parts = req_line.split()
+        parts = first_line.split()
         if len(parts) != 3:
             self._send_bytes(BAD_REQUEST, b"Bad request\n")
             return
 
-        method, target, httpver = parts
-        if method not in METHODS:
-            headers = self._read_headers()
-            headers_lc = _lower_headers(headers)
-            cl = int(headers_lc.get(HEADER_CONTENT_LENGTH.lower(), "0") or "0")
+        method_token, target, httpver = parts
+        method = _METHODS_BY_TOKEN.get(method_token)
+        if method is None:
+            headers_lc = self._read_headers()
+            cl = int(headers_lc.get(_HDR_CONTENT_LENGTH_LC, b"0") or b"0")
             if cl > 0:
                 self._discard_body(cl)
             self._send_bytes(METHOD_NOT_ALLOWED, b"Method not allowed\n")
             return
 
-        if not httpver.startswith("HTTP/"):
-            headers = self._read_headers()
-            headers_lc = _lower_headers(headers)
-            cl = int(headers_lc.get(HEADER_CONTENT_LENGTH.lower(), "0") or "0")
+        if not httpver.startswith(b"HTTP/"):
+            headers_lc = self._read_headers()
+            cl = int(headers_lc.get(_HDR_CONTENT_LENGTH_LC, b"0") or b"0")
             if cl > 0:
                 self._discard_body(cl)
             self._send_bytes(BAD_REQUEST, b"Bad request\n")
             return
 
-        ver = httpver.split("/", 1)[1]
-        if ver != HTTP_VERSION:
-            headers = self._read_headers()
-            headers_lc = _lower_headers(headers)
-            cl = int(headers_lc.get(HEADER_CONTENT_LENGTH.lower(), "0") or "0")
+        ver = httpver.split(b"/", 1)[1]
+        if ver != _HTTP_VERSION_B:
+            headers_lc = self._read_headers()
+            cl = int(headers_lc.get(_HDR_CONTENT_LENGTH_LC, b"0") or b"0")
             if cl > 0:
                 self._discard_body(cl)
             self._send_bytes(BAD_REQUEST, b"Bad request\n")
             return
 
-        headers = self._read_headers()
-        headers_lc = _lower_headers(headers)
-        content_length = int(headers_lc.get(HEADER_CONTENT_LENGTH.lower(), "0") or "0")
+        headers_lc = self._read_headers()
+        content_length = int(headers_lc.get(_HDR_CONTENT_LENGTH_LC, b"0") or b"0")
 
-        host_header = headers_lc.get(HEADER_HOST.lower(), "")
-        if _host_only(host_header) != self.server.server_domain:
+        host_header = headers_lc.get(_HDR_HOST_LC, b"")
+        if _host_only(host_header) != self.server.server_domain_bytes:
             if content_length > 0:
                 self._discard_body(content_length)
             self._send_bytes(BAD_REQUEST, b"Bad request\n")
             return
 
         try:
-            fs_path = _safe_resolve(self.server.working_directory, target)
+            fs_path = _safe_resolve(self.server.working_directory, target.decode("latin-1"))
         except Exception:
             if content_length > 0:
                 self._discard_body(content_length)
             self._send_bytes(NOT_FOUND, b"Not found\n")
             return
 
-        want_gzip = _wants_gzip(headers_lc)
-
-        if method == GET:
-            self._handle_get(fs_path, want_gzip)
-            return
-        if method == POST:
-            self._handle_post(fs_path, headers_lc, content_length)
-            return
-        if method == PUT:
-            self._handle_put(fs_path, content_length)
-            return
-        if method == DELETE:
-            self._handle_delete(fs_path, headers_lc)
+        handler = self._METHOD_HANDLERS.get(method)
+        if handler is None:
+            if content_length > 0:
+                self._discard_body(content_length)
+            self._send_bytes(METHOD_NOT_ALLOWED, b"Method not allowed\n")
             return
+        handler(self, fs_path, headers_lc, content_length)
 
-        if content_length > 0:
-            self._discard_body(content_length)
-        self._send_bytes(METHOD_NOT_ALLOWED, b"Method not allowed\n")
-
-    def _read_headers(self) -> t.Dict[str, str]:
-        headers: t.Dict[str, str] = {}
+    def _read_headers(self) -> t.Dict[bytes, bytes]:
+        # names are lower-cased here, in the same pass that splits the lines
+        headers: t.Dict[bytes, bytes] = {}
         while True:
             line = self.rfile.readline()
             if not line:
                 break
             if line in (b"\r\n", b"\n"):
                 break
-            s = line.decode("latin-1").rstrip("\r\n")
-            if ":" not in s:
+            k, sep, v = line.partition(b":")
+            if not sep:
                 continue
-            k, v = s.split(":", 1)
-            headers[k.strip()] = v.strip()
+            headers[k.strip().lower()] = v.strip()
         return headers
 
     def _read_exact_to(self, n: int, out) -> None:
-        remaining = n
-        while remaining > 0:
-            chunk = self.rfile.read(min(64 * 1024, remaining))
-            if not chunk:
-                break
-            out.write(chunk)
-            remaining -= len(chunk)
+        self._recv_body(n, out)
 
     def _discard_body(self, n: int) -> None:
+        self._recv_body(n, None)
+
+    def _recv_body(self, n: int, out) -> None:
+        # drain what rfile already buffered while reading the headers, then
+        # recv_into buf straight from the socket, bypassing BufferedReader;
+        # each write gets up to a full buf, not whatever one recv returned
+        buf = _io_buffer()
         remaining = n
+
+        pending = self.rfile.read1(min(remaining, len(self.rfile.peek(0)))) if remaining > 0 else b""
+        if pending:
+            if out is not None:
+                out.write(pending)
+            remaining -= len(pending)
+
+        recv_into = self.connection.recv_into
         while remaining > 0:
-            chunk = self.rfile.read(min(64 * 1024, remaining))
-            if not chunk:
+            want = min(remaining, len(buf))
+            filled = 0
+            while filled < want:
+                got = recv_into(buf[filled:want])
+                if not got:
+                    break
+                filled += got
+            if out is not None and filled:
+                out.write(buf[:filled])
+            remaining -= filled
+            if filled < want:
+                # peer closed the connection before sending the whole body
                 break
-            remaining -= len(chunk)
-
-    def _send_response_head(self, status: str, headers: t.Dict[str, str]) -> None:
-        reason = HTTP_REASON_BY_STATUS.get(status, "")
-        status_line = f"HTTP/{HTTP_VERSION} {status} {reason}\r\n"
-        self.wfile.write(status_line.encode("latin-1"))
-
-        headers_out = dict(headers)
-        headers_out[HEADER_SERVER] = SERVER_NAME
-        headers_out["Connection"] = "close"
-
-        for k, v in headers_out.items():
-            self.wfile.write(f"{k}: {v}\r\n".encode("latin-1"))
-        self.wfile.write(b"\r\n")
-
-    def _send_bytes(self, status: str, body: bytes, content_type: str = TEXT_PLAIN, extra_headers: t.Optional[t.Dict[str, str]] = None) -> None:
-        hdrs = {
-            HEADER_CONTENT_TYPE: content_type,
-            HEADER_CONTENT_LENGTH: str(len(body)),
-        }
+
+    def _send_response_head(self, status: str, content_type: str, headers: t.Dict[str, str]) -> None:
+        self.wfile.write(_response_head(status, content_type, headers))
+
+    def _send_bytes(self, status: str, body: bytes, content_type: t.Optional[str] = None, extra_headers: t.Optional[t.Dict[str, str]] = None) -> None:
+        # without an explicit type, text/plain is only claimed when there is a body
+        if content_type is None:
+            if not body and not extra_headers and status in _EMPTY_RESPONSES:
+                self.wfile.write(_EMPTY_RESPONSES[status])
+                self.wfile.flush()
+                return
+            content_type = TEXT_PLAIN
+
+        hdrs = {HEADER_CONTENT_LENGTH: str(len(body))}
         if extra_headers:
             hdrs.update(extra_headers)
-        self._send_response_head(status, hdrs)
+        self._send_response_head(status, content_type, hdrs)
         if body:
             self.wfile.write(body)
         self.wfile.flush()
 
-    def _handle_get(self, fs_path: pathlib.Path, want_gzip: bool) -> None:
-        if not fs_path.exists():
+    def _handle_get(self, fs_path: pathlib.Path, headers_lc: t.Dict[bytes, bytes], content_length: int) -> None:
+        want_gzip = _wants_gzip(headers_lc)
+
+        st = _stat_or_none(fs_path)
+        if st is None:
             self._send_bytes(NOT_FOUND, b"Not found\n")
             return
 
-        if fs_path.is_dir():
-            listing = _format_dir_listing(fs_path).encode("utf-8", "replace")
-            if want_gzip and listing:
+        if statmod.S_ISDIR(st.st_mode):
+            chunks = _iter_dir_listing(fs_path)
+            first = next(chunks, b"")
+            if want_gzip and first:
                 self._send_response_head(
                     OK,
+                    TEXT_PLAIN,
                     {
-                        HEADER_CONTENT_TYPE: TEXT_PLAIN,
                         HEADER_CONTENT_ENCODING: GZIP,
                     },
                 )
-                gz = gzip.GzipFile(fileobj=self.wfile, mode="wb")
-                try:
-                    gz.write(listing)
-                finally:
-                    gz.close()
-                self.wfile.flush()
+                self._write_gzip(itertools.chain((first,), chunks))
                 return
 
-            self._send_bytes(OK, listing, content_type=TEXT_PLAIN)
+            # plain listings keep their Content-Length, so these are joined once
+            self._send_bytes(OK, first + b"".join(chunks), content_type=TEXT_PLAIN)
             return
 
         content_type = _guess_content_type(fs_path)
 
         if want_gzip:
+            cache = self.server.gzip_cache
+            key = cache.key(fs_path, st) if cache is not None else None
+            cached = cache.open(key) if key is not None else None
+            if cached is not None:
+                with cached as f:
+                    size = os.fstat(f.fileno()).st_size
+                    self._send_response_head(
+                        OK,
+                        content_type,
+                        {
+                            HEADER_CONTENT_ENCODING: GZIP,
+                            HEADER_CONTENT_LENGTH: str(size),
+                        },
+                    )
+                    self._send_file_body(f, size)
+                return
+
             self._send_response_head(
                 OK,
+                content_type,
                 {
-                    HEADER_CONTENT_TYPE: content_type,
                     HEADER_CONTENT_ENCODING: GZIP,
                 },
             )
-            with open(fs_path, "rb") as f:
-                gz = gzip.GzipFile(fileobj=self.wfile, mode="wb")
+            fill = cache.start(key) if key is not None else None
+            with open(fs_path, "rb", buffering=0) as f:
+                if fill is None:
+                    self._write_gzip(_iter_file_chunks(f))
+                    return
+                done = False
                 try:
-                    shutil.copyfileobj(f, gz, length=64 * 1024)
+                    self._write_gzip(_iter_file_chunks(f), fill)
+                    done = True
                 finally:
-                    gz.close()
-            self.wfile.flush()
+                    # a file that changed size while being read is not the version the key names
+                    cache.finish(fill, done and f.tell() == st.st_size)
             return
 
-        size = fs_path.stat().st_size
+        size = st.st_size
         self._send_response_head(
             OK,
+            content_type,
             {
-                HEADER_CONTENT_TYPE: content_type,
                 HEADER_CONTENT_LENGTH: str(size),
             },
         )
         with open(fs_path, "rb") as f:
-            shutil.copyfileobj(f, self.wfile, length=64 * 1024)
+            self._send_file_body(f, size)
+
+    def _write_gzip(self, chunks: t.Iterable[bytes], tee: t.Optional[GzipCacheFill] = None) -> None:
+        # a bare compressobj instead of GzipFile: no Python-level crc/size
+        # bookkeeping per write, the deflate stream carries the gzip framing itself
+        co = zlib.compressobj(self.server.gzip_level, zlib.DEFLATED, GZIP_WBITS)
+        for chunk in chunks:
+            data = co.compress(chunk)
+            self.wfile.write(data)
+            if tee is not None:
+                tee.write(data)
+        data = co.flush()
+        self.wfile.write(data)
+        if tee is not None:
+            tee.write(data)
         self.wfile.flush()
 
-    def _handle_post(self, fs_path: pathlib.Path, headers_lc: t.Dict[str, str], content_length: int) -> None:
-        if fs_path.exists():
+    def _send_file_body(self, f, size: int) -> None:
+        if hasattr(os, "sendfile"):
+            self.wfile.flush()
+            self._sendfile(f, size)
+        else:
+            shutil.copyfileobj(f, self.wfile, length=IO_CHUNK)
+        self.wfile.flush()
+
+    def _sendfile(self, f, size: int) -> None:
+        # file -> socket inside the kernel, no userspace copy per chunk
+        sock_fd = self.connection.fileno()
+        file_fd = f.fileno()
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(sock_fd, file_fd, offset, min(size - offset, 8 * 1024 * 1024))
+            if sent == 0:
+                break
+            offset += sent
+
+    def _handle_post(self, fs_path: pathlib.Path, headers_lc: t.Dict[bytes, bytes], content_length: int) -> None:
+        if _stat_or_none(fs_path) is not None:
             if content_length > 0:
                 self._discard_body(content_length)
             self._send_bytes(CONFLICT, b"Conflict\n")
             return
 
-        parent = fs_path.parent
-        if not parent.exists() or not parent.is_dir():
+        parent_st = _stat_or_none(fs_path.parent)
+        if parent_st is None or not statmod.S_ISDIR(parent_st.st_mode):
             if content_length > 0:
                 self._discard_body(content_length)
             self._send_bytes(NOT_FOUND, b"Not found\n")
             return
 
-        create_dir = _parse_bool(headers_lc.get(HEADER_CREATE_DIRECTORY.lower(), "False"))
+        create_dir = _parse_bool(headers_lc.get(_HDR_CREATE_DIRECTORY_LC, b"False"))
 
         if create_dir:
             try:
@@ -362,14 +673,15 @@ class HTTPHandler(StreamRequestHandler):
 
         self._send_bytes(OK, b"")
 
-    def _handle_put(self, fs_path: pathlib.Path, content_length: int) -> None:
-        if not fs_path.exists():
+    def _handle_put(self, fs_path: pathlib.Path, headers_lc: t.Dict[bytes, bytes], content_length: int) -> None:
+        st = _stat_or_none(fs_path)
+        if st is None:
             if content_length > 0:
                 self._discard_body(content_length)
             self._send_bytes(NOT_FOUND, b"Not found\n")
             return
 
-        if fs_path.is_dir():
+        if statmod.S_ISDIR(st.st_mode):
             if content_length > 0:
                 self._discard_body(content_length)
             self._send_bytes(CONFLICT, b"Conflict\n")
@@ -381,13 +693,14 @@ class HTTPHandler(StreamRequestHandler):
 
         self._send_bytes(OK, b"")
 
-    def _handle_delete(self, fs_path: pathlib.Path, headers_lc: t.Dict[str, str]) -> None:
-        if not fs_path.exists():
+    def _handle_delete(self, fs_path: pathlib.Path, headers_lc: t.Dict[bytes, bytes], content_length: int) -> None:
+        st = _stat_or_none(fs_path)
+        if st is None:
             self._send_bytes(NOT_FOUND, b"Not found\n")
             return
 
-        if fs_path.is_dir():
-            remove_dir = _parse_bool(headers_lc.get(HEADER_REMOVE_DIRECTORY.lower(), "False"))
+        if statmod.S_ISDIR(st.st_mode):
+            remove_dir = _parse_bool(headers_lc.get(_HDR_REMOVE_DIRECTORY_LC, b"False"))
             if not remove_dir:
                 self._send_bytes(NOT_ACCEPTABLE, b"Not acceptable\n")
                 return
@@ -398,13 +711,37 @@ class HTTPHandler(StreamRequestHandler):
         fs_path.unlink()
         self._send_bytes(OK, b"")
 
+    # all handlers take (fs_path, headers_lc, content_length), whether they use them or not
+    _METHOD_HANDLERS = {
+        GET: _handle_get,
+        POST: _handle_post,
+        PUT: _handle_put,
+        DELETE: _handle_delete,
+    }
+
+
+def _serve_connection(conn: socket.socket, addr, server: HTTPServer) -> None:
+    try:
+        # Handle the request
+        HTTPHandler(conn, addr, server)
+
+        # Close the connection
+        conn.shutdown(socket.SHUT_WR)
+        conn.close()
+    except Exception as e:
+        logger.error("Connection from %s failed: %s", addr, e)
+        conn.close()
+
 
 @click.command()
 @click.option("--host", type=str)
 @click.option("--port", type=int)
 @click.option("--server-domain", type=str)
 @click.option("--working-directory", type=str)
-def main(host, port, server_domain, working_directory):
+# ISA-L only has levels 0-3, so the bound follows whichever zlib was imported
+@click.option("--gzip-level", type=click.IntRange(0, GZIP_MAX_LEVEL))
+@click.option("--gzip-cache-size", type=click.IntRange(0))
+def main(host, port, server_domain, working_directory, gzip_level, gzip_cache_size):
     if host is None:
         host = os.environ.get("SERVER_HOST", "0.0.0.0")
 
@@ -421,10 +758,26 @@ def main(host, port, server_domain, working_directory):
     if not working_directory:
         sys.exit(1)
 
-    working_directory_path = pathlib.Path(working_directory)
+    if gzip_level is None:
+        # level 1 (best speed): gzip responses are CPU-bound, and it is several
+        # times faster than the default 9 for a modestly worse ratio
+        lvl = os.environ.get("SERVER_GZIP_LEVEL", "")
+        gzip_level = int(lvl) if lvl else 1
+        if not 0 <= gzip_level <= GZIP_MAX_LEVEL:
+            raise click.BadParameter(f"{gzip_level} is not in the range 0<=x<={GZIP_MAX_LEVEL}.", param_hint="SERVER_GZIP_LEVEL")
+
+    if gzip_cache_size is None:
+        sz = os.environ.get("SERVER_GZIP_CACHE_SIZE", "")
+        gzip_cache_size = int(sz) if sz else 256 * 1024 * 1024
+
+    gzip_cache = None
+    if gzip_cache_size > 0:
+        gzip_cache = GzipCache(gzip_cache_size, gzip_level)
+
+    working_directory_path = pathlib.Path(working_directory).resolve()
 
     logger.info(
-        f"Starting server on {host}:{port}, domain {server_domain}, working directory {working_directory}"
+        "Starting server on %s:%s, domain %s, working directory %s", host, port, server_domain, working_directory
     )
 
     # Create a server socket
@@ -438,26 +791,32 @@ def main(host, port, server_domain, working_directory):
     # Start listening for incoming connections
     s.listen()
 
-    logger.info(f"Listening at {s.getsockname()}")
-    server = HTTPServer((host, port), s, server_domain, working_directory_path)
-
-    while True:
-        # Accept any new connection (request, client_address)
-        try:
-            conn, addr = s.accept()
-        except OSError:
-            break
-
-        try:
-            # Handle the request
-            HTTPHandler(conn, addr, server)
-
-            # Close the connection
-            conn.shutdown(socket.SHUT_WR)
-            conn.close()
-        except Exception as e:
-            logger.error(e)
-            conn.close()
+    logger.info("Listening at %s", s.getsockname())
+    server = HTTPServer((host, port), s, server_domain, working_directory_path, gzip_level, gzip_cache)
+
+    # SIGTERM unwinds like Ctrl+C, so the gzip cache directory gets removed.
+    # Python runs signal handlers on the main thread between bytecodes; a signal
+    # that lands on a worker, or just before accept() blocks, would otherwise wait
+    # for the next connection, so accept() wakes up on its own every half second
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    s.settimeout(0.5)
+
+    try:
+        # connections are served concurrently, so a slow client no longer holds up the rest
+        with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as pool:
+            while True:
+                # Accept any new connection (request, client_address)
+                try:
+                    conn, addr = s.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+
+                pool.submit(_serve_connection, conn, addr, server)
+    finally:
+        if gzip_cache is not None:
+            gzip_cache.close()
 
 
 if __name__ == "__main__":